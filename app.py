@@ -19,19 +19,35 @@ import os
 import pandas as pd
 
 from openai import OpenAI
-from flask import Flask, render_template, request, session
+from flask import Flask, render_template, request, session, make_response, url_for
 
 import utils as utils
+import batch as batch
+import assets as assets
+import profiling as profiling
+import reranking as reranking
+import tracing as tracing
 
 app = Flask(__name__)
 # Has to be set for session variables, but 'unnecessary' for singular demo purposes
 # Randomly generate each time the app is run, saved states cause issues across versions
 app.secret_key = "oooohsooooseeeecret"
+# Caps uploads to the batch route, every description in them costs an embedding
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+
+# Serve fingerprinted, pre-compressed static assets and compress rendered HTML
+assets.init_assets(app)
+
+# Opt-in request profiling, see profiling.py for how to enable it
+profiling.init_profiling(app)
 
 # Set up OpenAI API access
 api_key = os.environ.get('OPENAI_API_KEY')
 client = OpenAI(api_key=api_key)
 
+# Opt-in recording of anonymised session traces, see tracing.py and replay.py
+client = tracing.init_tracing(app, client)
+
 # Choose dataset to use, do not put file ending at the end
 # Allows for easy 'hotswapping' of used databases
 dataset_embeddings = "embeddings_2025-06-26"
@@ -39,14 +55,35 @@ dataset_embeddings = "embeddings_2025-06-26"
 # Load data
 df_embeddings = pd.read_pickle('data/processed/' + dataset_embeddings + '.pkl')
 
+# Prebuilt 2D map of the dataset for the explore page
+map_folder = os.path.join(app.static_folder, 'map', dataset_embeddings)
+
 # Prepare FAISS index
 faiss_index = utils.get_faiss_index(df_embeddings)
 emotion_list = df_embeddings['Emotion'].tolist()
 
+# Weights to strengthen (positive) or weaken (negative) candidate recommendations per feature,
+# see data/data_utils.py for available features. All 0 keeps the closest emotion of each band.
+feature_weights = {
+    'Feature_English': 0.0,
+}
+# Penalty on similarity between the 3 recommended emotions, higher gives more varied sets
+diversity = 0.0
+reranker = reranking.Reranker(df_embeddings, weights=feature_weights, diversity=diversity)
+
+# Show the results page right away, and let it fetch new emotions once the embedding and search are done
+stream_results = True
+
 ##### Landing page #####
 @app.route('/', methods=['GET', 'POST'])
 def index():
-    return render_template('index.html')
+    
+    # Landing page is the same for everyone, so let browsers revalidate it with an ETag
+    response = make_response(render_template('index.html'))
+    response.add_etag()
+    response.headers['Cache-Control'] = 'no-cache'
+    
+    return response.make_conditional(request)
 
 ##### First pass #####
 @app.route('/starting', methods=['POST'])
@@ -63,7 +100,7 @@ def get_emotions():
     user_input = request.form.get('user_input')
     chosen_emotion = request.form.get('chosen_emotion')
     
-    return utils.handle_get_emotions(user_input, chosen_emotion, df_embeddings, session, client, faiss_index, emotion_list)
+    return utils.handle_get_emotions(user_input, chosen_emotion, df_embeddings, session, client, faiss_index, emotion_list, reranker, stream_results)
 
 ##### Choose an old emotion #####
 @app.route('/rewind', methods=['POST'])
@@ -72,7 +109,7 @@ def rewind_to_emotion():
     target_emotion = request.form.get('target_emotion')
     target_set_index = int(request.form.get('target_set_index'))
 
-    return utils.handle_rewind_to_emotion(target_emotion, target_set_index, df_embeddings, session, client, faiss_index, emotion_list)
+    return utils.handle_rewind_to_emotion(target_emotion, target_set_index, df_embeddings, session, client, faiss_index, emotion_list, reranker, stream_results)
 
 ##### Choose no emotions #####
 @app.route('/skip', methods=['POST'])
@@ -80,7 +117,13 @@ def skip_emotions():
     
     user_input = request.form.get('user_input')
     
-    return utils.handle_skip_emotions(df_embeddings, user_input, session, client, faiss_index, emotion_list)
+    return utils.handle_skip_emotions(df_embeddings, user_input, session, client, faiss_index, emotion_list, reranker, stream_results)
+
+##### New emotions for a page rendered while they were pending #####
+@app.route('/recommendations', methods=['POST'])
+def get_recommendations():
+    
+    return utils.handle_recommendations(df_embeddings, session, client, faiss_index, emotion_list, reranker)
 
 ##### Print out receipt #####
 @app.route('/finish', methods=['POST'])
@@ -100,6 +143,35 @@ def update_collection():
     
     return utils.handle_update_collection(data, session)
 
+##### Explore all emotions on a map, without an experience #####
+@app.route('/explore', methods=['GET'])
+def explore():
+    
+    # New visitor without an experience, start with an empty session like the first pass does
+    utils.init_session(session)
+    
+    # Map itself gets loaded from static tiles by the page, see data/build_map.py
+    return render_template('explore.html', map_index_url=url_for('map_tile', filename='index.json'))
+
+##### Static tiles of the emotion map #####
+@app.route('/explore/map/<path:filename>', methods=['GET'])
+def map_tile(filename):
+    
+    return assets.send_precompressed(map_folder, filename, 'public, max-age=86400')
+
+##### Batch recommendations for research use #####
+@app.route('/batch', methods=['POST'])
+def batch_recommendations():
+    
+    # Costs embedding calls, so only for those with the admin token
+    utils.check_admin_token(request)
+    
+    # JSONL or CSV file of experience descriptions, results get streamed back as JSON lines
+    uploaded_file = request.files['file']
+    top_k = request.form.get('top_k', '10')
+    
+    return batch.handle_batch(uploaded_file, top_k, client, faiss_index, emotion_list, reranker)
+
 # Run main system
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8000, debug=True)
@@ -0,0 +1,244 @@
+# E*star is an artwork on discovering intercultural language that describes emotion.
+# Copyright (C) 2024  Ferdinand Kok
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import re
+import gzip
+import json
+import hashlib
+import mimetypes
+
+from flask import request, url_for, send_from_directory
+
+# Brotli is optional, assets only get pre-compressed with gzip without it
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+####################
+#
+# assets.py
+#
+# Static asset pipeline: minifies, fingerprints and pre-compresses the files in static/,
+# and serves them with long-lived cache headers. Also compresses rendered HTML responses.
+#
+# Build the assets before running the app with: python assets.py
+# Without a build, or for files edited since the last build, templates fall back to the
+# plain files in static/. Set ESTAR_PLAIN_ASSETS=1 to always use the plain files.
+#
+####################
+
+# Files in static/ to put through the pipeline
+ASSETS = ['styles.css', 'scripts.js', 'explore.js']
+
+# Fingerprinted files never change, so browsers can keep them for a year
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Responses smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 500
+
+def minify_css(css):
+    """Minify CSS by stripping comments and unnecessary whitespace.
+
+    Args:
+        css (str): CSS source
+
+    Returns:
+        str: minified CSS
+    """
+
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.DOTALL)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    css = css.replace(';}', '}')
+
+    return css.strip()
+
+def minify_js(js):
+    """Conservatively minify JavaScript by stripping indentation, blank lines and full-line comments.
+
+    Args:
+        js (str): JavaScript source
+
+    Returns:
+        str: minified JavaScript
+    """
+
+    lines = (line.strip() for line in js.splitlines())
+
+    return '\n'.join(line for line in lines if line and not line.startswith('//'))
+
+def build_assets(static_folder='static', dist_folder='dist'):
+    """Minify, fingerprint and pre-compress all assets, writing a manifest of the fingerprinted names.
+
+    Args:
+        static_folder (str, optional): folder containing the source assets. Defaults to 'static'.
+        dist_folder (str, optional): subfolder of static_folder to write the built assets to. Defaults to 'dist'.
+
+    Returns:
+        dict: manifest mapping source filenames to fingerprinted filenames
+    """
+
+    dist_path = os.path.join(static_folder, dist_folder)
+    os.makedirs(dist_path, exist_ok=True)
+    minifiers = {'.css': minify_css, '.js': minify_js}
+    manifest = {}
+
+    for filename in ASSETS:
+        with open(os.path.join(static_folder, filename), encoding='utf-8') as f:
+            source = f.read()
+
+        name, extension = os.path.splitext(filename)
+        content = minifiers[extension](source).encode('utf-8')
+        fingerprint = hashlib.md5(content).hexdigest()[:10]
+        fingerprinted_name = f"{name}.{fingerprint}{extension}"
+
+        with open(os.path.join(dist_path, fingerprinted_name), 'wb') as f:
+            f.write(content)
+        # mtime=0 keeps the gzipped output identical between builds
+        with open(os.path.join(dist_path, fingerprinted_name + '.gz'), 'wb') as f:
+            f.write(gzip.compress(content, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(os.path.join(dist_path, fingerprinted_name + '.br'), 'wb') as f:
+                f.write(brotli.compress(content))
+
+        manifest[filename] = fingerprinted_name
+        print(f"Built {filename} -> {fingerprinted_name} ({len(source)} -> {len(content)} bytes)")
+
+    with open(os.path.join(dist_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest
+
+def accepts_encoding(encoding):
+    """Check whether the current request accepts the given content encoding.
+
+    Args:
+        encoding (str): content encoding, e.g. 'gzip' or 'br'
+
+    Returns:
+        bool: True if the client accepts the encoding
+    """
+
+    return request.accept_encodings.quality(encoding) > 0
+
+def send_precompressed(directory, filename, cache_control):
+    """Send a file, using a pre-compressed .br or .gz variant of it when available and accepted by the client.
+
+    Args:
+        directory (str): folder containing the file
+        filename (str): name of the file within the folder
+        cache_control (str): Cache-Control header to send along
+
+    Returns:
+        flask.Response: response sending the file
+    """
+
+    mimetype = mimetypes.guess_type(filename)[0]
+
+    for encoding, extension in [('br', '.br'), ('gzip', '.gz')]:
+        if accepts_encoding(encoding) and os.path.exists(os.path.join(directory, filename + extension)):
+            response = send_from_directory(directory, filename + extension, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(directory, filename, mimetype=mimetype)
+
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = cache_control
+
+    return response
+
+def compress_response(response):
+    """Gzip rendered HTML responses if the client accepts it. Used as after_request hook.
+
+    Args:
+        response (flask.Response): response to compress
+
+    Returns:
+        flask.Response: compressed response, or the original if not applicable
+    """
+
+    if (response.status_code != 200 or
+            response.mimetype != 'text/html' or
+            response.direct_passthrough or
+            response.is_streamed or
+            'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_SIZE or not accepts_encoding('gzip'):
+        return response
+
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+
+    # Body no longer matches the ETag byte for byte, so it can only be a weak match
+    etag, is_weak = response.get_etag()
+    if etag and not is_weak:
+        response.set_etag(etag, weak=True)
+
+    return response
+
+def init_assets(app, dist_folder='dist'):
+    """Set up serving of the built assets and compression of HTML responses on the flask app.
+    Makes asset_url() available in templates, which points to the fingerprinted file when built.
+
+    Args:
+        app (flask.Flask): flask app to set up
+        dist_folder (str, optional): subfolder of the static folder holding the built assets. Defaults to 'dist'.
+    """
+
+    dist_path = os.path.join(app.static_folder, dist_folder)
+    manifest_path = os.path.join(dist_path, 'manifest.json')
+
+    if os.environ.get('ESTAR_PLAIN_ASSETS') == '1':
+        print("ESTAR_PLAIN_ASSETS set, serving plain static files.")
+        manifest = {}
+    elif os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        # Sources edited since the last build would be shadowed by their outdated builds, so serve those plain
+        built_time = os.path.getmtime(manifest_path)
+        stale = [filename for filename in manifest
+                 if not os.path.exists(os.path.join(app.static_folder, filename))
+                 or os.path.getmtime(os.path.join(app.static_folder, filename)) > built_time]
+        if stale:
+            print(f"Built assets are outdated for {', '.join(stale)}, serving plain static files for these. "
+                  "Run 'python assets.py' to rebuild them.")
+        manifest = {filename: built for filename, built in manifest.items() if filename not in stale}
+    else:
+        print("No built assets found, serving plain static files. Run 'python assets.py' to build them.")
+        manifest = {}
+
+    def asset_url(filename):
+        if filename in manifest:
+            return url_for('assets', filename=manifest[filename])
+        return url_for('static', filename=filename)
+
+    def serve_asset(filename):
+        return send_precompressed(dist_path, filename, IMMUTABLE_CACHE_CONTROL)
+
+    app.add_url_rule('/assets/<path:filename>', 'assets', serve_asset)
+    app.context_processor(lambda: {'asset_url': asset_url})
+    app.after_request(compress_response)
+
+if __name__ == '__main__':
+    build_assets()
@@ -0,0 +1,249 @@
+# E*star is an artwork on discovering intercultural language that describes emotion.
+# Copyright (C) 2024  Ferdinand Kok
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import csv
+import io
+import json
+import argparse
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+from openai import OpenAI, BadRequestError
+from flask import Response, stream_with_context, abort
+
+import utils as utils
+import reranking as reranking
+
+####################
+#
+# batch.py
+#
+# Batch recommendations for research use: takes a JSONL or CSV file of experience
+# descriptions and streams back the closest emotions and recommended picks per description.
+# Can be used from the command line, or through the /batch route of the flask app.
+#
+####################
+
+def read_records(lines, file_format, text_field='text', id_field='id'):
+    """Lazily read experience descriptions from a JSONL or CSV file.
+
+    Args:
+        lines (Iterable[str]): lines of the input file
+        file_format (str): either 'jsonl' or 'csv'
+        text_field (str, optional): field/column holding the description. Defaults to 'text'.
+        id_field (str, optional): field/column holding an identifier, line number is used if missing. Defaults to 'id'.
+
+    Yields:
+        tuple[str, str]: identifier and description of each record
+    """
+
+    if file_format == 'csv':
+        rows = csv.DictReader(lines)
+    elif file_format == 'jsonl':
+        rows = (line for line in lines if line.strip())
+    else:
+        raise ValueError(f"Unknown file format '{file_format}', expected 'jsonl' or 'csv'")
+
+    for line_number, row in enumerate(rows, start=1):
+        # A single malformed record should not end the whole batch, so skip these as well
+        if file_format == 'jsonl':
+            try:
+                row = json.loads(row)
+            except json.JSONDecodeError as e:
+                print(f"Skipping record {line_number}: invalid JSON ({e})", file=sys.stderr)
+                continue
+        if not isinstance(row, dict):
+            print(f"Skipping record {line_number}: not a JSON object", file=sys.stderr)
+            continue
+
+        text = row.get(text_field)
+        # Embedder rejects empty strings, so skip these
+        if not text or not str(text).strip():
+            print(f"Skipping record {line_number}: no '{text_field}' found", file=sys.stderr)
+            continue
+        yield row.get(id_field, line_number), str(text)
+
+def embed_batch(texts, client):
+    """Embed a batch of descriptions in a single request, falling back to one request per description
+    when the batch gets rejected, so a single bad description (e.g. over the token limit) only fails itself.
+
+    Args:
+        texts (list[str]): descriptions to embed
+        client (OpenAI): OpenAI API client
+
+    Returns:
+        tuple[list, dict]: embedding per description (None if rejected), and the error per rejected position
+    """
+
+    try:
+        return list(utils.get_embeddings(texts, client)), {}
+    except BadRequestError as e:
+        if len(texts) == 1:
+            return [None], {0: str(e)}
+        print(f"Batch of {len(texts)} descriptions rejected, embedding them one by one: {e}", file=sys.stderr)
+
+    embeddings, errors = [], {}
+    for position, text in enumerate(texts):
+        try:
+            embeddings.append(utils.get_embeddings([text], client)[0])
+        except BadRequestError as e:
+            embeddings.append(None)
+            errors[position] = str(e)
+
+    return embeddings, errors
+
+def recommend_batch(records, client, faiss_index, emotion_list, top_k=10, batch_size=256, modify_input=True, reranker=None):
+    """Find the closest emotions and the recommended picks for a stream of descriptions.
+    Descriptions are embedded batch_size at a time in a single request, and searched as one matrix,
+    so memory stays bounded no matter the size of the input.
+
+    Args:
+        records (Iterable[tuple[str, str]]): identifier and description of each record
+        client (OpenAI): OpenAI API client
+        faiss_index (faiss.swigfaiss.IndexFlatL2): FAISS index of embeddings
+        emotion_list (list): list of emotions to choose from
+        top_k (int, optional): amount of closest emotions to return per description. Defaults to 10.
+        batch_size (int, optional): amount of descriptions per embedding request. Defaults to 256.
+        modify_input (bool, optional): wrap descriptions in the same prompt the app uses. Defaults to True.
+        reranker (reranking.Reranker, optional): scores candidates within each band like the app does, closest first if None. Defaults to None.
+
+    Yields:
+        dict: results per description, in input order. Descriptions the embedder rejected only get an 'error'.
+    """
+
+    if top_k < 1:
+        raise ValueError(f"top_k should be a positive number, got {top_k}")
+
+    records = iter(records)
+    bands = utils.get_percentile_bands(len(emotion_list))
+
+    # Only search as deep as is needed for both the top k and the deepest recommendation band
+    search_k = min(max(top_k, bands[-1][1]), len(emotion_list))
+
+    for batch in iter(lambda: list(islice(records, batch_size)), []):
+        record_ids, texts = zip(*batch)
+        if modify_input:
+            texts = [utils.modify_user_input(text) for text in texts]
+
+        embeddings, errors = embed_batch(texts, client)
+        embedded = [embedding for embedding in embeddings if embedding is not None]
+        results = iter([])
+        if embedded:
+            distances, indices = faiss_index.search(np.array(embedded, dtype='float32'), search_k)
+            results = zip(distances, indices)
+
+        for position, record_id in enumerate(record_ids):
+            if position in errors:
+                print(f"Skipping record {record_id}: rejected by the embedder ({errors[position]})", file=sys.stderr)
+                yield {'id': record_id, 'error': errors[position]}
+                continue
+            row_distances, row_indices = next(results)
+
+            # Same banding and scoring as the app, without any previously shown emotions
+            recommended_emotions = []
+            for start, end in bands:
+                if reranker is not None:
+                    emotion = reranker.pick_from_band(row_distances, row_indices, start, end, [], recommended_emotions)
+                    if emotion is not None:
+                        recommended_emotions.append(emotion)
+                        continue
+                for idx in row_indices[start:end]:
+                    if emotion_list[idx] not in recommended_emotions:
+                        recommended_emotions.append(emotion_list[idx])
+                        break
+                else:
+                    recommended_emotions.append(None)
+
+            yield {
+                'id': record_id,
+                'emotions': [{'emotion': emotion_list[idx], 'distance': float(distance)}
+                             for idx, distance in zip(row_indices[:top_k], row_distances[:top_k])],
+                'recommended': recommended_emotions
+            }
+
+def handle_batch(uploaded_file, top_k, client, faiss_index, emotion_list, reranker=None, max_records=10000):
+    """Handle a batch recommendation request, streaming results back as JSON lines.
+
+    Args:
+        uploaded_file (werkzeug.datastructures.FileStorage): uploaded JSONL or CSV file
+        top_k (str): amount of closest emotions to return per description, as given in the form
+        client (OpenAI): OpenAI API client
+        faiss_index (faiss.swigfaiss.IndexFlatL2): FAISS index of embeddings
+        emotion_list (list): list of emotions to choose from
+        reranker (reranking.Reranker, optional): reranker used by the app, so picks match the app's. Defaults to None.
+        max_records (int, optional): maximum amount of descriptions handled per upload, as each costs an embedding. Defaults to 10000.
+
+    Returns:
+        Response: streamed newline-delimited JSON response
+    """
+
+    if not str(top_k).isdigit() or int(top_k) < 1:
+        abort(400, description="top_k should be a positive whole number")
+    top_k = int(top_k)
+
+    file_format = 'csv' if uploaded_file.filename.lower().endswith('.csv') else 'jsonl'
+    # Only split on actual newlines, codecs readers also split on characters like U+2028 within records
+    lines = io.TextIOWrapper(uploaded_file.stream, encoding='utf-8', errors='replace', newline='')
+    records = islice(read_records(lines, file_format), max_records)
+
+    def generate():
+        for result in recommend_batch(records, client, faiss_index, emotion_list, top_k=top_k, reranker=reranker):
+            yield json.dumps(result, ensure_ascii=False) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def main():
+    parser = argparse.ArgumentParser(description="Get emotion recommendations for a file of experience descriptions.")
+    parser.add_argument('input', help="JSONL or CSV file with experience descriptions")
+    parser.add_argument('-o', '--output', help="JSONL file to write results to. Defaults to stdout.")
+    parser.add_argument('--format', choices=['jsonl', 'csv'], help="input format, guessed from file ending if not given")
+    parser.add_argument('--text-field', default='text', help="field/column holding the description")
+    parser.add_argument('--id-field', default='id', help="field/column holding an identifier")
+    parser.add_argument('--top-k', type=int, default=10, help="amount of closest emotions to return per description")
+    parser.add_argument('--batch-size', type=int, default=256, help="amount of descriptions per embedding request")
+    parser.add_argument('--raw', action='store_true', help="embed descriptions as-is, without the app's prompt")
+    parser.add_argument('--weight', action='append', default=[], metavar='FEATURE=WEIGHT',
+                        help="feature weight for picking recommendations, as set in app.py, e.g. Feature_English=-0.05")
+    parser.add_argument('--diversity', type=float, default=0.0, help="diversity penalty for picking recommendations, as set in app.py")
+    parser.add_argument('--dataset', default='embeddings_2025-06-26', help="name of dataset in data/processed, without file ending")
+    args = parser.parse_args()
+
+    file_format = args.format or ('csv' if args.input.lower().endswith('.csv') else 'jsonl')
+
+    client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
+    df_embeddings = pd.read_pickle('data/processed/' + args.dataset + '.pkl')
+    faiss_index = utils.get_faiss_index(df_embeddings)
+    emotion_list = df_embeddings['Emotion'].tolist()
+    feature_weights = {name: float(weight) for name, weight in (item.split('=', 1) for item in args.weight)}
+    reranker = reranking.Reranker(df_embeddings, weights=feature_weights, diversity=args.diversity)
+
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        with open(args.input, newline='', encoding='utf-8') as f:
+            records = read_records(f, file_format, args.text_field, args.id_field)
+            for result in recommend_batch(records, client, faiss_index, emotion_list,
+                                          top_k=args.top_k, batch_size=args.batch_size, modify_input=not args.raw,
+                                          reranker=reranker):
+                output.write(json.dumps(result, ensure_ascii=False) + '\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+# E*star is an artwork on discovering intercultural language that describes emotion.
+# Copyright (C) 2024  Ferdinand Kok
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import gzip
+import json
+import argparse
+
+import numpy as np
+import pandas as pd
+
+####################
+#
+# build_map.py
+#
+# Builds the 2D emotion map used by the /explore page. Embeddings are projected to 2D with PCA
+# and clustered with k-means, after which all emotions are split over a grid of static JSON tiles.
+# The app only serves these files, so exploring costs (almost) no work on the server.
+#
+# Run from within the data folder, e.g.: python build_map.py embeddings_2025-06-26
+#
+####################
+
+def normalise_embeddings(df_embeddings):
+    """Get the L2 normalised embedding matrix.
+
+    Args:
+        df_embeddings (pandas.core.frame.DataFrame): DataFrame of embeddings and metadata
+
+    Returns:
+        numpy.ndarray: float32 matrix of shape (n_emotions, embedding_dim)
+    """
+
+    embeddings = np.array(df_embeddings['Embedding'].tolist(), dtype='float32')
+
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+def project_2d(embeddings):
+    """Project embeddings onto their first 2 principal components, scaled to [0, 1].
+
+    Args:
+        embeddings (numpy.ndarray): embedding matrix
+
+    Returns:
+        numpy.ndarray: coordinates of shape (n_emotions, 2)
+    """
+
+    centered = embeddings - embeddings.mean(axis=0)
+    # Eigenvectors of the covariance matrix, eigh returns them in ascending order of eigenvalue
+    _, eigenvectors = np.linalg.eigh(centered.T @ centered)
+    coordinates = centered @ eigenvectors[:, -2:][:, ::-1]
+
+    coordinates -= coordinates.min(axis=0)
+    coordinates /= np.maximum(coordinates.max(axis=0), 1e-9)
+
+    return coordinates
+
+def cluster_embeddings(embeddings, n_clusters=16, iterations=25, seed=0):
+    """Cluster normalised embeddings with spherical k-means (cosine similarity).
+
+    Args:
+        embeddings (numpy.ndarray): L2 normalised embedding matrix
+        n_clusters (int, optional): amount of clusters. Defaults to 16.
+        iterations (int, optional): amount of k-means iterations. Defaults to 25.
+        seed (int, optional): random seed for picking the initial centroids. Defaults to 0.
+
+    Returns:
+        tuple[numpy.ndarray, numpy.ndarray]: cluster per emotion, and the row of the emotion closest to each centroid
+    """
+
+    n_clusters = min(n_clusters, len(embeddings))
+    rng = np.random.default_rng(seed)
+    centroids = embeddings[rng.choice(len(embeddings), n_clusters, replace=False)]
+
+    for _ in range(iterations):
+        labels = np.argmax(embeddings @ centroids.T, axis=1)
+        for cluster in range(n_clusters):
+            members = embeddings[labels == cluster]
+            # Empty clusters keep their previous centroid
+            if len(members):
+                centroid = members.sum(axis=0)
+                centroids[cluster] = centroid / np.linalg.norm(centroid)
+
+    similarities = embeddings @ centroids.T
+    labels = np.argmax(similarities, axis=1)
+
+    return labels, np.argmax(similarities, axis=0)
+
+def write_json(data, path):
+    """Write data as compact JSON, along with a gzipped copy for clients that accept it.
+
+    Args:
+        data (dict): data to write
+        path (str): location of the JSON file
+    """
+
+    content = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(content)
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(content, compresslevel=9, mtime=0))
+
+def build_map(df_embeddings, output_path, n_tiles=4, n_clusters=16):
+    """Build the 2D emotion map, writing an index.json and one JSON file per non-empty tile.
+
+    Args:
+        df_embeddings (pandas.core.frame.DataFrame): DataFrame of embeddings and metadata
+        output_path (str): folder to write the map to
+        n_tiles (int, optional): amount of tiles along each axis. Defaults to 4.
+        n_clusters (int, optional): amount of clusters. Defaults to 16.
+    """
+
+    os.makedirs(output_path, exist_ok=True)
+
+    embeddings = normalise_embeddings(df_embeddings)
+    coordinates = project_2d(embeddings)
+    labels, centre_rows = cluster_embeddings(embeddings, n_clusters)
+
+    # Tile per emotion, coordinates of exactly 1 belong to the last tile
+    tile_positions = np.minimum((coordinates * n_tiles).astype(int), n_tiles - 1)
+
+    # Missing values are not valid JSON
+    df_text = df_embeddings[['Emotion', 'Language', 'Description']].fillna('')
+
+    tiles = {}
+    for row, (x, y) in enumerate(coordinates):
+        tile_x, tile_y = tile_positions[row]
+        tiles.setdefault(f"{tile_x}_{tile_y}", []).append({
+            'emotion': df_text['Emotion'].iloc[row],
+            'language': df_text['Language'].iloc[row],
+            'description': df_text['Description'].iloc[row],
+            'cluster': int(labels[row]),
+            'x': round(float(x), 4),
+            'y': round(float(y), 4)
+        })
+
+    for tile_name, points in tiles.items():
+        write_json({'points': points}, os.path.join(output_path, tile_name + '.json'))
+
+    clusters = []
+    for cluster, centre_row in enumerate(centre_rows):
+        members = labels == cluster
+        if not members.any():
+            continue
+        x, y = coordinates[members].mean(axis=0)
+        clusters.append({
+            'id': cluster,
+            'label': df_text['Emotion'].iloc[centre_row],
+            'size': int(members.sum()),
+            'x': round(float(x), 4),
+            'y': round(float(y), 4)
+        })
+
+    write_json({'tiles': n_tiles, 'count': len(df_embeddings), 'tile_names': sorted(tiles), 'clusters': clusters},
+               os.path.join(output_path, 'index.json'))
+
+    print(f"Built map of {len(df_embeddings)} emotions in {len(tiles)} tiles and {len(clusters)} clusters at {output_path}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the 2D emotion map for the /explore page.")
+    parser.add_argument('dataset', help="name of dataset in processed/, without file ending")
+    parser.add_argument('--tiles', type=int, default=4, help="amount of tiles along each axis")
+    parser.add_argument('--clusters', type=int, default=16, help="amount of clusters")
+    args = parser.parse_args()
+
+    df_embeddings = pd.read_pickle('processed/' + args.dataset + '.pkl')
+    build_map(df_embeddings, os.path.join('..', 'static', 'map', args.dataset), args.tiles, args.clusters)
+
+if __name__ == '__main__':
+    main()
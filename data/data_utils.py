@@ -15,6 +15,7 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import time
+import pandas as pd
 from openai import OpenAIError
 
 ####################
@@ -51,3 +52,32 @@ def get_embedding(description, client, model="text-embedding-3-large", retries=1
                 time.sleep(delay)
             else:
                 raise
+
+def add_feature_columns(df_clean, df_raw):
+    """Add numeric per-emotion feature columns, used by the recommender to strengthen or weaken candidates.
+    All feature columns are prefixed with 'Feature_', and are picked up by reranking.py in the app.
+
+    Features:
+    - Feature_English: 1 if the emotion is English, else 0
+    - Feature_Familiarity: general familiarity of the emotion, from an optional 'Familiarity' column in the raw data
+    - Feature_Sentiment: sentiment of the emotion (-1 to 1), from an optional 'Sentiment' column in the raw data
+
+    Args:
+        df_clean (pandas.core.frame.DataFrame): cleaned dataset, with at least a 'Language' column
+        df_raw (pandas.core.frame.DataFrame): raw dataset to take optional columns from, with the same index
+
+    Returns:
+        pandas.core.frame.DataFrame: copy of df_clean with feature columns added
+    """
+    df_features = df_clean.copy()
+    
+    df_features['Feature_English'] = (df_features['Language'].str.strip().str.lower() == 'english').astype('float32')
+    
+    # Optional columns that may not be filled in (yet) count as neutral
+    for column in ['Familiarity', 'Sentiment']:
+        if column in df_raw.columns:
+            df_features['Feature_' + column] = pd.to_numeric(df_raw[column], errors='coerce').fillna(0).astype('float32')
+        else:
+            df_features['Feature_' + column] = 0.0
+    
+    return df_features
@@ -0,0 +1,193 @@
+# E*star is an artwork on discovering intercultural language that describes emotion.
+# Copyright (C) 2024  Ferdinand Kok
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import csv
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+####################
+#
+# find_duplicates.py
+#
+# Curation tool for the emotions dataset: finds clusters of near-duplicate entries, and
+# equivalent emotions across languages, by comparing all pairs of embeddings.
+# Similarities are computed block by block from a memory mapped matrix, so the full
+# NxN similarity matrix is never held in memory, and blocks are spread over all cores.
+#
+# Run from within the data folder, e.g.: python find_duplicates.py embeddings_2025-06-26
+#
+####################
+
+# Normalised embedding matrix, memory mapped once per worker process
+_embedding_matrix = None
+
+def write_normalised_matrix(df_embeddings, path):
+    """Write the L2 normalised embeddings to a .npy file, row by row to keep memory bounded.
+
+    Args:
+        df_embeddings (pandas.core.frame.DataFrame): DataFrame of embeddings and metadata
+        path (str): location of the .npy file to write
+    """
+
+    embedding_dim = len(df_embeddings['Embedding'].iloc[0])
+    matrix = np.lib.format.open_memmap(path, mode='w+', dtype='float32', shape=(len(df_embeddings), embedding_dim))
+
+    for row, embedding in enumerate(df_embeddings['Embedding']):
+        embedding = np.asarray(embedding, dtype='float32')
+        matrix[row] = embedding / np.linalg.norm(embedding)
+
+    matrix.flush()
+    del matrix
+
+def _init_worker(path):
+    global _embedding_matrix
+    _embedding_matrix = np.load(path, mmap_mode='r')
+
+def _similar_pairs_in_row_block(start, block_size, threshold):
+    """Find all pairs above the threshold between one block of rows and every row after it.
+
+    Args:
+        start (int): first row of the block
+        block_size (int): amount of rows (and columns) per block
+        threshold (float): minimum cosine similarity of a pair
+
+    Returns:
+        tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]: row indices, column indices and similarities of the pairs
+    """
+
+    n_rows = _embedding_matrix.shape[0]
+    rows_block = np.asarray(_embedding_matrix[start:start + block_size])
+    rows, cols, similarities = [], [], []
+
+    # Only compare against the upper triangle, every pair gets visited once
+    for col_start in range(start, n_rows, block_size):
+        cols_block = np.asarray(_embedding_matrix[col_start:col_start + block_size])
+        block_similarities = rows_block @ cols_block.T
+        above_threshold = block_similarities >= threshold
+        if col_start == start:
+            above_threshold = np.triu(above_threshold, k=1)
+
+        block_rows, block_cols = np.nonzero(above_threshold)
+        rows.append(block_rows + start)
+        cols.append(block_cols + col_start)
+        similarities.append(block_similarities[block_rows, block_cols])
+
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(similarities)
+
+def find_similar_pairs(matrix_path, n_rows, threshold=0.9, block_size=1024, workers=None):
+    """Find all pairs of embeddings with a cosine similarity above the threshold, in parallel.
+
+    Args:
+        matrix_path (str): location of the normalised .npy embedding matrix
+        n_rows (int): amount of rows in the matrix
+        threshold (float, optional): minimum cosine similarity of a pair. Defaults to 0.9.
+        block_size (int, optional): amount of rows per block, bounds memory use per worker. Defaults to 1024.
+        workers (int, optional): amount of worker processes. Defaults to amount of cores.
+
+    Returns:
+        list[tuple[int, int, float]]: row index pairs and their similarity
+    """
+
+    starts = list(range(0, n_rows, block_size))
+    pairs = []
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(matrix_path,)) as executor:
+        for rows, cols, similarities in executor.map(_similar_pairs_in_row_block, starts,
+                                                     [block_size] * len(starts), [threshold] * len(starts)):
+            pairs.extend(zip(rows.tolist(), cols.tolist(), similarities.tolist()))
+
+    return pairs
+
+def cluster_pairs(pairs):
+    """Group pairs of similar rows into clusters, using union-find.
+
+    Args:
+        pairs (list[tuple[int, int, float]]): row index pairs and their similarity
+
+    Returns:
+        list[list[int]]: clusters of row indices, largest cluster first
+    """
+
+    parents = {}
+
+    def find(row):
+        parents.setdefault(row, row)
+        while parents[row] != row:
+            # Path halving keeps trees shallow
+            parents[row] = parents[parents[row]]
+            row = parents[row]
+        return row
+
+    for row, col, _ in pairs:
+        parents[find(row)] = find(col)
+
+    clusters = {}
+    for row in parents:
+        clusters.setdefault(find(row), []).append(row)
+
+    return sorted((sorted(cluster) for cluster in clusters.values()), key=len, reverse=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Find near-duplicate and cross-language equivalent emotions in the dataset.")
+    parser.add_argument('dataset', help="name of dataset in processed/, without file ending")
+    parser.add_argument('--threshold', type=float, default=0.9, help="minimum cosine similarity to count as near-duplicate")
+    parser.add_argument('--block-size', type=int, default=1024, help="rows per block, bounds memory use per worker")
+    parser.add_argument('--workers', type=int, default=None, help="amount of worker processes, defaults to amount of cores")
+    parser.add_argument('-o', '--output', help="CSV file to write the clusters to")
+    args = parser.parse_args()
+
+    df_embeddings = pd.read_pickle('processed/' + args.dataset + '.pkl')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        matrix_path = os.path.join(tmp_dir, 'embeddings.npy')
+        write_normalised_matrix(df_embeddings, matrix_path)
+        pairs = find_similar_pairs(matrix_path, len(df_embeddings), args.threshold, args.block_size, args.workers)
+
+    # Highest similarity each row has within its cluster
+    best_similarity = {}
+    for row, col, similarity in pairs:
+        best_similarity[row] = max(best_similarity.get(row, 0), similarity)
+        best_similarity[col] = max(best_similarity.get(col, 0), similarity)
+
+    clusters = cluster_pairs(pairs)
+    print(f"Found {len(pairs)} pairs in {len(clusters)} clusters above a similarity of {args.threshold}\n")
+
+    report = []
+    for cluster_id, cluster in enumerate(clusters):
+        languages = df_embeddings['Language'].iloc[cluster]
+        kind = 'cross-language' if languages.nunique() > 1 else 'near-duplicate'
+        print(f"Cluster {cluster_id} ({kind}, {len(cluster)} entries)")
+        for row in cluster:
+            emotion = df_embeddings['Emotion'].iloc[row]
+            language = df_embeddings['Language'].iloc[row]
+            print(f"    row {row}: {emotion} [{language}] (similarity {best_similarity[row]:.3f})")
+            report.append({'cluster': cluster_id, 'kind': kind, 'row': row, 'emotion': emotion,
+                           'language': language, 'similarity': round(best_similarity[row], 4)})
+        print()
+
+    if args.output:
+        with open(args.output, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=['cluster', 'kind', 'row', 'emotion', 'language', 'similarity'])
+            writer.writeheader()
+            writer.writerows(report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+# E*star is an artwork on discovering intercultural language that describes emotion.
+# Copyright (C) 2024  Ferdinand Kok
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import random
+import threading
+import zlib
+from collections import Counter
+from datetime import datetime
+from html import escape
+
+from flask import g, request, abort, render_template, send_from_directory, Response
+
+import utils as utils
+
+####################
+#
+# profiling.py
+#
+# Opt-in request profiling. A sampling profiler records the call stack of the thread handling
+# a request at a fixed interval, which is cheap enough to leave on during an exhibition.
+# Profiles are saved per request in folded stack format, and get added to aggregated profiles
+# (per endpoint and for all requests), which are saved along with their flame graphs. All of these
+# can be listed, downloaded and viewed as flame graphs on /admin/profiles.
+#
+# Configured through environment variables:
+# - ESTAR_PROFILE_RATE: fraction of requests to profile, e.g. 0.05. Defaults to 0.
+# - ESTAR_PROFILE_HEADER: set to 1 to profile requests sent with an 'X-Estar-Profile: 1' header.
+# - ESTAR_PROFILE_DIR: directory to save profiles to. Defaults to 'profiles'.
+# - ESTAR_PROFILE_INTERVAL: seconds between samples. Defaults to 0.005.
+# - ESTAR_PROFILE_MAX_FILES: per-request profiles to keep, oldest get deleted first. Defaults to 1000.
+#   Aggregated profiles keep the samples of deleted ones.
+# - ESTAR_ADMIN_TOKEN: required as ?token= to access the admin page, which is only available when set.
+#
+# When neither rate nor header is set, nothing gets registered on the app at all.
+#
+####################
+
+PROFILE_HEADER = 'X-Estar-Profile'
+
+# Aggregated profiles are saved as aggregate_<endpoint>.folded/.svg, and aggregate_all for all requests
+AGGREGATE_PREFIX = 'aggregate_'
+
+class StackSampler:
+    """Samples the call stack of a single thread at a fixed interval, from a background thread."""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self.start_time
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+
+            # Folded stacks go from root to leaf
+            self.stacks[';'.join(reversed(stack))] += 1
+
+def write_folded(stacks, path):
+    """Write stacks to a file in folded stack format, one 'frame;frame;frame count' per line.
+
+    Args:
+        stacks (collections.Counter): sample counts per folded stack
+        path (str): location of file to write
+    """
+
+    with open(path, 'w', encoding='utf-8') as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+
+def read_folded(path):
+    """Read stacks from a file in folded stack format.
+
+    Args:
+        path (str): location of file to read
+
+    Returns:
+        collections.Counter: sample counts per folded stack
+    """
+
+    stacks = Counter()
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack:
+                stacks[stack] += int(count)
+
+    return stacks
+
+def render_flamegraph(stacks, title='Flame graph', width=1200, frame_height=16):
+    """Render stacks as a flame graph in SVG, with the root at the bottom. Hover over frames for details.
+
+    Args:
+        stacks (collections.Counter): sample counts per folded stack
+        title (str, optional): title shown above the graph. Defaults to 'Flame graph'.
+        width (int, optional): width of the graph in pixels. Defaults to 1200.
+        frame_height (int, optional): height of each frame in pixels. Defaults to 16.
+
+    Returns:
+        str: SVG document
+    """
+
+    # Merge stacks into a tree of sample counts
+    root = {'count': 0, 'children': {}}
+    max_depth = 0
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        max_depth = max(max_depth, len(frames))
+        root['count'] += count
+        node = root
+        for frame in frames:
+            node = node['children'].setdefault(frame, {'count': 0, 'children': {}})
+            node['count'] += count
+
+    total = max(root['count'], 1)
+    top_margin = 24
+    height = (max_depth + 1) * frame_height + top_margin
+    rects = []
+
+    def layout(name, node, x, depth):
+        frame_width = node['count'] / total * width
+        # Frames too small to see are skipped, along with their children
+        if frame_width < 0.5:
+            return
+
+        y = height - (depth + 1) * frame_height
+        # Colour is stable per frame name, in warm tones
+        hue = zlib.crc32(name.encode('utf-8')) % 60
+        # Roughly 7 pixels per character, truncate labels that do not fit
+        max_chars = int(frame_width / 7)
+        label = name if len(name) <= max_chars else (name[:max_chars - 2] + '..' if max_chars > 4 else '')
+        rects.append(
+            f'<g><title>{escape(name)} ({node["count"]} samples, {node["count"] / total:.1%})</title>'
+            f'<rect x="{x:.1f}" y="{y}" width="{frame_width:.1f}" height="{frame_height - 1}" fill="hsl({hue}, 80%, 60%)"/>'
+            f'<text x="{x + 3:.1f}" y="{y + frame_height - 4}">{escape(label)}</text></g>'
+        )
+
+        child_x = x
+        for child_name, child in sorted(node['children'].items()):
+            layout(child_name, child, child_x, depth + 1)
+            child_x += child['count'] / total * width
+
+    layout('all', root, 0, 0)
+
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="monospace" font-size="11">'
+        f'<text x="{width / 2}" y="16" text-anchor="middle" font-size="14">{escape(title)} ({root["count"]} samples)</text>'
+        + ''.join(rects) +
+        '</svg>'
+    )
+
+def init_profiling(app):
+    """Set up opt-in request profiling on the flask app, based on the environment variables described above.
+
+    Args:
+        app (flask.Flask): flask app to set up
+    """
+
+    sample_rate = float(os.environ.get('ESTAR_PROFILE_RATE', 0))
+    header_enabled = os.environ.get('ESTAR_PROFILE_HEADER') == '1'
+
+    # Cost nothing when disabled
+    if sample_rate <= 0 and not header_enabled:
+        return
+
+    profile_dir = os.path.abspath(os.environ.get('ESTAR_PROFILE_DIR', 'profiles'))
+    interval = float(os.environ.get('ESTAR_PROFILE_INTERVAL', 0.005))
+    max_files = int(os.environ.get('ESTAR_PROFILE_MAX_FILES', 1000))
+    os.makedirs(profile_dir, exist_ok=True)
+    # Concurrent requests update the same aggregated profiles
+    aggregate_lock = threading.Lock()
+    print(f"Profiling enabled (rate {sample_rate}, header {header_enabled}), saving to {profile_dir}")
+
+    @app.before_request
+    def start_profiling():
+        if request.endpoint in utils.INTERNAL_ENDPOINTS:
+            return
+        flagged = header_enabled and request.headers.get(PROFILE_HEADER) == '1'
+        if flagged or random.random() < sample_rate:
+            g.profiler = StackSampler(threading.get_ident(), interval)
+            g.profiler.start()
+
+    # Per-request profiles, newest first
+    def profile_files():
+        return sorted((f for f in os.listdir(profile_dir)
+                       if f.endswith('.folded') and not f.startswith(AGGREGATE_PREFIX)), reverse=True)
+
+    def aggregate_files():
+        return sorted(f for f in os.listdir(profile_dir) if f.startswith(AGGREGATE_PREFIX) and f.endswith('.folded'))
+
+    def update_aggregate(name, stacks):
+        path = os.path.join(profile_dir, f"{AGGREGATE_PREFIX}{name}.folded")
+        aggregated = read_folded(path) if os.path.exists(path) else Counter()
+        aggregated.update(stacks)
+        write_folded(aggregated, path)
+        with open(path[:-len('.folded')] + '.svg', 'w', encoding='utf-8') as f:
+            f.write(render_flamegraph(aggregated, f"{name} (all profiled requests)"))
+
+    # Teardown runs after streamed responses have finished as well
+    @app.teardown_request
+    def stop_profiling(exception=None):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return
+        profiler.stop()
+
+        timestamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        filename = f"{timestamp}_{request.endpoint}_{profiler.duration * 1000:.0f}ms.folded"
+        write_folded(profiler.stacks, os.path.join(profile_dir, filename))
+
+        with aggregate_lock:
+            update_aggregate('all', profiler.stacks)
+            update_aggregate(request.endpoint, profiler.stacks)
+
+            # Keep disk use bounded when profiling is left on, samples of deleted profiles stay in the aggregates
+            for old_profile in profile_files()[max_files:]:
+                os.remove(os.path.join(profile_dir, old_profile))
+
+    # Profiles expose code paths and timings, so the admin page is only available with a token
+    if not os.environ.get('ESTAR_ADMIN_TOKEN'):
+        print("No ESTAR_ADMIN_TOKEN set, profiles can only be viewed from " + profile_dir)
+        return
+
+    @app.route('/admin/profiles')
+    def list_profiles():
+        utils.check_admin_token(request)
+        # Endpoint, folded profile and flame graph of each aggregate
+        aggregates = [(f[len(AGGREGATE_PREFIX):-len('.folded')], f, f[:-len('.folded')] + '.svg') for f in aggregate_files()]
+        return render_template('profiles.html', profiles=profile_files(), aggregates=aggregates,
+                               token=request.args.get('token'))
+
+    @app.route('/admin/profiles/download/<filename>')
+    def download_profile(filename):
+        utils.check_admin_token(request)
+        return send_from_directory(profile_dir, filename, as_attachment=True)
+
+    # Flame graph of a single profile, aggregated ones are already saved as SVG
+    @app.route('/admin/profiles/flamegraph/<filename>')
+    def view_flamegraph(filename):
+        utils.check_admin_token(request)
+        if filename in aggregate_files():
+            return send_from_directory(profile_dir, filename[:-len('.folded')] + '.svg', mimetype='image/svg+xml')
+        if filename not in profile_files():
+            abort(404)
+        stacks = read_folded(os.path.join(profile_dir, filename))
+
+        return Response(render_flamegraph(stacks, filename), mimetype='image/svg+xml')
@@ -0,0 +1,257 @@
+# E*star is an artwork on discovering intercultural language that describes emotion.
+# Copyright (C) 2024  Ferdinand Kok
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import argparse
+import resource
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+
+from tracing import decode_embedding
+
+####################
+#
+# replay.py
+#
+# Replays session traces recorded by tracing.py against the app, to compare changes on real
+# visitor behaviour. Embeddings come from the recorded trace instead of the API, so replays
+# are free. Sessions run concurrently, at original or accelerated speed, after which latency
+# per route and resource use get reported.
+#
+# Replays are not fully deterministic: concurrent sessions share numpy's global random state,
+# so random emotions (base emotions, fallbacks) can differ between runs. Choices are replayed
+# by their position on screen, so every session still takes the same path.
+#
+# Run from the root of the repo, e.g.: python replay.py traces.jsonl --speed 10
+#
+####################
+
+class StubClient:
+    """Stands in for the OpenAI client, returning recorded embeddings queued for the current thread."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self.embeddings = self
+
+    def queue(self, embeddings):
+        self._local.queue = list(embeddings)
+
+    def create(self, input, model=None):
+        inputs = input if isinstance(input, list) else [input]
+        queue = getattr(self._local, 'queue', [])
+        if len(queue) < len(inputs):
+            raise RuntimeError("Replay requested more embeddings than were recorded for this action")
+
+        embeddings, self._local.queue = queue[:len(inputs)], queue[len(inputs):]
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=embedding) for i, embedding in enumerate(embeddings)])
+
+def load_traces(path):
+    """Load recorded events, grouped per trace.
+
+    Args:
+        path (str): location of the trace log
+
+    Returns:
+        dict: list of events per trace id, in order of time
+    """
+
+    traces = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                event = json.loads(line)
+                traces.setdefault(event['trace_id'], []).append(event)
+
+    for events in traces.values():
+        events.sort(key=lambda event: event['time'])
+
+    return traces
+
+def build_request(event, previous_emotions):
+    """Rebuild the request of a recorded event, choosing emotions by their recorded position on screen.
+
+    Args:
+        event (dict): recorded event
+        previous_emotions (list): emotions shown so far in the replayed session
+
+    Returns:
+        tuple[dict, dict]: form fields and JSON body of the request, either may be None
+    """
+
+    fields = dict(event['fields'])
+
+    # Free text is replaced with placeholder text of the same length
+    if 'user_input_length' in fields:
+        fields['user_input'] = 'x' * max(fields.pop('user_input_length'), 1)
+
+    # Same position as the original choice, as emotions shown may differ (e.g. random base emotions)
+    if 'chosen_position' in fields:
+        fields['chosen_emotion'] = previous_emotions[-3:][fields.pop('chosen_position')]
+    if 'target_position' in fields:
+        set_index = int(fields['target_set_index'])
+        fields['target_emotion'] = previous_emotions[set_index * 3:(set_index + 1) * 3][fields.pop('target_position')]
+
+    if event['endpoint'] == 'update_collection':
+        return None, fields
+    return fields, None
+
+def replay_trace(app, stub_client, events, replay_start, first_time, speed, results, results_lock):
+    """Replay all events of a single trace with its own cookie jar, at the given speed.
+
+    Args:
+        app (flask.Flask): app to replay against
+        stub_client (StubClient): stub embedder used by the app
+        events (list[dict]): recorded events of the trace
+        replay_start (float): perf_counter time the replay started
+        first_time (float): time of the first recorded event across all traces
+        speed (float): speed up factor of the original timing, 0 for no waiting
+        results (list): list to append results to
+        results_lock (threading.Lock): lock for appending results
+    """
+
+    test_client = app.test_client()
+
+    # Pending emotions get fetched right after the page, like the browser does (see below), so recorded
+    # fetches are merged into the action before them. Keeps traces from before and after streaming comparable.
+    merged_events = []
+    for event in events:
+        if event['endpoint'] == 'get_recommendations' and merged_events:
+            merged_events[-1] = dict(merged_events[-1], embeddings=merged_events[-1]['embeddings'] + event['embeddings'],
+                                     recommendations_duration=event['duration'])
+        else:
+            merged_events.append(event)
+
+    for event in merged_events:
+        if speed > 0:
+            delay = replay_start + (event['time'] - first_time) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        with test_client.session_transaction() as session:
+            previous_emotions = list(session.get('previous_emotions', []))
+
+        try:
+            form, body = build_request(event, previous_emotions)
+        except (IndexError, KeyError, ValueError):
+            # Session state differs from the original, e.g. trace started mid-session
+            with results_lock:
+                results.append({'endpoint': event['endpoint'], 'status': 'skipped', 'duration': 0,
+                                'recorded_duration': event['duration']})
+            continue
+
+        stub_client.queue(decode_embedding(embedding) for embedding in event['embeddings'])
+
+        start = time.perf_counter()
+        response = test_client.open(event['path'], method=event['method'], data=form, json=body)
+        page = response.get_data(as_text=True)
+        duration = time.perf_counter() - start
+
+        with results_lock:
+            results.append({'endpoint': event['endpoint'], 'status': response.status_code, 'duration': duration,
+                            'recorded_duration': event['duration']})
+
+        # Page was rendered before new emotions were ready, fetch them with the remaining embeddings
+        if 'id="pending-emotions"' in page:
+            start = time.perf_counter()
+            response = test_client.post('/recommendations')
+            response.get_data()
+            duration = time.perf_counter() - start
+
+            with results_lock:
+                results.append({'endpoint': 'get_recommendations', 'status': response.status_code, 'duration': duration,
+                                'recorded_duration': event.get('recommendations_duration')})
+
+def print_report(results, wall_time, cpu_time, max_rss):
+    """Print latency per endpoint and resource use of the replay.
+
+    Args:
+        results (list[dict]): result per replayed event
+        wall_time (float): total duration of the replay in seconds
+        cpu_time (float): CPU time used during the replay in seconds
+        max_rss (int): peak resident memory of the process in kilobytes
+    """
+
+    print(f"\nReplayed {len(results)} actions in {wall_time:.2f}s "
+          f"(CPU {cpu_time:.2f}s, peak memory {max_rss / 1024:.0f}MB)\n")
+    print(f"{'endpoint':<22}{'count':>7}{'errors':>8}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'recorded p50':>14}")
+
+    for endpoint in sorted({result['endpoint'] for result in results}):
+        endpoint_results = [result for result in results if result['endpoint'] == endpoint]
+        replayed = [result for result in endpoint_results if result['status'] != 'skipped']
+        errors = sum(1 for result in endpoint_results if result['status'] == 'skipped' or result['status'] >= 400)
+        if not replayed:
+            print(f"{endpoint:<22}{len(endpoint_results):>7}{errors:>8}")
+            continue
+
+        durations = np.array([result['duration'] for result in replayed]) * 1000
+        # Traces from before streaming have no recorded duration for fetching pending emotions
+        recorded = np.array([result['recorded_duration'] for result in replayed
+                             if result['recorded_duration'] is not None]) * 1000
+        recorded_p50 = f"{np.percentile(recorded, 50):.1f}" if len(recorded) else '-'
+        print(f"{endpoint:<22}{len(endpoint_results):>7}{errors:>8}{durations.mean():>10.1f}"
+              f"{np.percentile(durations, 50):>10.1f}{np.percentile(durations, 95):>10.1f}"
+              f"{durations.max():>10.1f}{recorded_p50:>14}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded session traces against the app.")
+    parser.add_argument('trace_file', help="trace log recorded with ESTAR_TRACE_FILE")
+    parser.add_argument('--speed', type=float, default=1.0, help="speed up factor of the original timing, 0 for no waiting")
+    parser.add_argument('--seed', type=int, default=0, help="random seed, random emotions can still differ between runs as sessions run concurrently")
+    args = parser.parse_args()
+
+    # Replays should not record themselves
+    os.environ.pop('ESTAR_TRACE_FILE', None)
+    # App creates its OpenAI client on import, which fails without a key, while replays never call the API
+    os.environ.setdefault('OPENAI_API_KEY', 'replay')
+    np.random.seed(args.seed)
+
+    import app as app_module
+
+    stub_client = StubClient()
+    app_module.client = stub_client
+    # Replayed visitors should not print actual receipts
+    app_module.utils.print_emotion_collection = lambda *args, **kwargs: None
+
+    traces = load_traces(args.trace_file)
+    first_time = min(events[0]['time'] for events in traces.values())
+    print(f"Replaying {len(traces)} sessions with {sum(len(events) for events in traces.values())} actions")
+
+    results = []
+    results_lock = threading.Lock()
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    replay_start = time.perf_counter()
+
+    threads = [threading.Thread(target=replay_trace,
+                                args=(app_module.app, stub_client, events, replay_start, first_time,
+                                      args.speed, results, results_lock))
+               for events in traces.values()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    wall_time = time.perf_counter() - replay_start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_time = (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime)
+
+    print_report(results, wall_time, cpu_time, usage_end.ru_maxrss)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# E*star is an artwork on discovering intercultural language that describes emotion.
+# Copyright (C) 2024  Ferdinand Kok
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+
+####################
+#
+# reranking.py
+#
+# Weighted re-ranking of recommendation candidates. Each candidate within a percentile band gets a score:
+#
+#   similarity to user input + feature weights . features - diversity * similarity to emotions already picked
+#
+# Features are the 'Feature_' columns added at dataset build time (see data/data_utils.py), so
+# weights can strengthen or weaken candidates by language, familiarity, sentiment, etc.
+# Scoring runs as array operations over the whole band at once.
+#
+####################
+
+# Above this amount of emotions, pairwise similarities are computed per request instead of cached
+MAX_CACHED_SIMILARITIES = 5000
+
+class Reranker:
+    """Scores recommendation candidates on similarity, weighted features and diversity."""
+
+    def __init__(self, df_embeddings, weights=None, diversity=0.0):
+        """
+        Args:
+            df_embeddings (pandas.core.frame.DataFrame): DataFrame of embeddings and metadata
+            weights (dict, optional): weight per feature column, e.g. {'Feature_English': -0.05}. Defaults to None.
+            diversity (float, optional): penalty on similarity to emotions already picked in this set (MMR). Defaults to 0.0.
+        """
+
+        weights = weights or {}
+        self.emotions = np.array(df_embeddings['Emotion'].tolist(), dtype=object)
+        # Integer code per emotion name, so excluding emotions by name can be done on integer arrays
+        self.codes_by_emotion = {}
+        self.codes = np.array([self.codes_by_emotion.setdefault(emotion, len(self.codes_by_emotion))
+                               for emotion in self.emotions])
+        # First row of each emotion, to look up already picked emotions by name
+        self.rows = {}
+        for row, emotion in enumerate(self.emotions):
+            self.rows.setdefault(emotion, row)
+
+        # Older datasets have no feature columns, the language feature can still be derived
+        df_features = df_embeddings.filter(like='Feature_').copy()
+        if 'Feature_English' not in df_features.columns:
+            df_features['Feature_English'] = (df_embeddings['Language'].str.strip().str.lower() == 'english')
+
+        unknown_features = set(weights) - set(df_features.columns)
+        if unknown_features:
+            raise ValueError(f"Weights given for unknown features: {sorted(unknown_features)}")
+
+        self.feature_names = list(df_features.columns)
+        features = df_features.to_numpy(dtype='float32')
+        feature_weights = np.array([weights.get(name, 0.0) for name in self.feature_names], dtype='float32')
+        # Feature part of the score does not depend on user input, so combine it once
+        self.feature_scores = features @ feature_weights
+
+        self.diversity = diversity
+        self.similarities = None
+        if diversity:
+            embeddings = np.array(df_embeddings['Embedding'].tolist(), dtype='float32')
+            self.normalised_embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+            if len(self.emotions) <= MAX_CACHED_SIMILARITIES:
+                self.similarities = self.normalised_embeddings @ self.normalised_embeddings.T
+
+    def pair_similarities(self, candidates, picked):
+        """Get cosine similarities between candidate rows and picked rows.
+
+        Args:
+            candidates (numpy.ndarray): row indices of candidates
+            picked (list[int]): row indices of picked emotions
+
+        Returns:
+            numpy.ndarray: similarity matrix of shape (len(candidates), len(picked))
+        """
+
+        if self.similarities is not None:
+            return self.similarities[np.ix_(candidates, picked)]
+        return self.normalised_embeddings[candidates] @ self.normalised_embeddings[picked].T
+
+    def pick_from_band(self, distances, indices, start, end, previous_emotions, picked_emotions):
+        """Pick the best scoring emotion from a band of the search results.
+
+        Args:
+            distances (numpy.ndarray): squared L2 distances of search results, closest first
+            indices (numpy.ndarray): row indices of search results, closest first
+            start (int): start of the band within the search results
+            end (int): end of the band within the search results
+            previous_emotions (list): emotions shown before, which can not be picked again
+            picked_emotions (list): emotions already picked for the current set
+
+        Returns:
+            str: best scoring emotion, or None if every emotion in the band was shown before
+        """
+
+        candidates = indices[start:end]
+        if len(candidates) == 0:
+            return None
+
+        # Embeddings are unit length, so squared L2 distance converts directly to cosine similarity
+        scores = 1 - distances[start:end] / 2 + self.feature_scores[candidates]
+
+        picked = [self.rows[emotion] for emotion in picked_emotions if emotion in self.rows]
+        if self.diversity and picked:
+            scores -= self.diversity * self.pair_similarities(candidates, picked).max(axis=1)
+
+        excluded_codes = [self.codes_by_emotion[emotion] for emotion in list(previous_emotions) + list(picked_emotions)
+                          if emotion in self.codes_by_emotion]
+        scores[np.isin(self.codes[candidates], excluded_codes)] = -np.inf
+        best = np.argmax(scores)
+
+        if np.isneginf(scores[best]):
+            return None
+        return self.emotions[candidates[best]]
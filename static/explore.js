@@ -0,0 +1,118 @@
+document.addEventListener('DOMContentLoaded', function() {
+    // Size of a single tile of the map in pixels
+    const TILE_SIZE = 600;
+
+    const map = document.getElementById('emotion-map');
+    const canvas = document.getElementById('emotion-map-canvas');
+    const status = document.getElementById('emotion-map-status');
+    const descriptionText = document.getElementById('description-text');
+    const guidelinesText = document.getElementById('guidelines-text');
+    const mapIndexUrl = map.dataset.mapIndexUrl;
+    // Tiles live next to the index
+    const mapUrl = new URL('.', new URL(mapIndexUrl, window.location.href)).href;
+
+    const loadedTiles = new Set();
+    let mapIndex = null;
+
+    // Shows description of an emotion in the left sidebar, same as on the results page
+    function showDescription(point) {
+        descriptionText.innerHTML = '';
+        const title = document.createElement('strong');
+        title.textContent = point.emotion;
+        descriptionText.appendChild(title);
+        descriptionText.appendChild(document.createTextNode(` [${point.language}]`));
+        descriptionText.appendChild(document.createElement('br'));
+        descriptionText.appendChild(document.createTextNode(point.description));
+        guidelinesText.style.display = 'none';
+        descriptionText.style.display = 'block';
+    }
+
+    function hideDescription() {
+        guidelinesText.style.display = 'block';
+        descriptionText.style.display = 'none';
+    }
+
+    function addPoint(point) {
+        const div = document.createElement('div');
+        div.className = 'map-point';
+        div.style.left = `${point.x * mapIndex.tiles * TILE_SIZE}px`;
+        div.style.top = `${point.y * mapIndex.tiles * TILE_SIZE}px`;
+
+        const word = document.createElement('button');
+        word.className = 'map-word';
+        word.type = 'button';
+        word.textContent = point.emotion;
+        word.addEventListener('mouseenter', () => showDescription(point));
+        word.addEventListener('mouseleave', hideDescription);
+        // Tablets have no hover, so show description on click as well
+        word.addEventListener('click', () => showDescription(point));
+
+        // Adding to collection is handled by the shared collection logic
+        const add = document.createElement('button');
+        add.className = 'add-to-collection';
+        add.type = 'button';
+        add.dataset.emotion = point.emotion;
+        add.textContent = '+';
+        if (document.querySelector(`.collection-item[data-emotion="${CSS.escape(point.emotion)}"]`)) {
+            add.classList.add('in-collection');
+        }
+
+        div.appendChild(word);
+        div.appendChild(add);
+        canvas.appendChild(div);
+    }
+
+    // Only fetches tiles that are (about to be) visible and not loaded yet
+    function loadVisibleTiles() {
+        const firstX = Math.max(Math.floor(map.scrollLeft / TILE_SIZE), 0);
+        const lastX = Math.min(Math.floor((map.scrollLeft + map.clientWidth) / TILE_SIZE), mapIndex.tiles - 1);
+        const firstY = Math.max(Math.floor(map.scrollTop / TILE_SIZE), 0);
+        const lastY = Math.min(Math.floor((map.scrollTop + map.clientHeight) / TILE_SIZE), mapIndex.tiles - 1);
+
+        for (let x = firstX; x <= lastX; x++) {
+            for (let y = firstY; y <= lastY; y++) {
+                const tileName = `${x}_${y}`;
+                if (loadedTiles.has(tileName) || !mapIndex.tile_names.includes(tileName)) {
+                    continue;
+                }
+                loadedTiles.add(tileName);
+                fetch(`${mapUrl}${tileName}.json`)
+                    .then(response => response.json())
+                    .then(tile => tile.points.forEach(addPoint));
+            }
+        }
+    }
+
+    fetch(mapIndexUrl)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error('No map has been built for this dataset');
+            }
+            return response.json();
+        })
+        .then(index => {
+            mapIndex = index;
+            const size = mapIndex.tiles * TILE_SIZE;
+            canvas.style.width = `${size}px`;
+            canvas.style.height = `${size}px`;
+
+            // Cluster labels give a sense of direction whilst scrolling
+            mapIndex.clusters.forEach(cluster => {
+                const label = document.createElement('div');
+                label.className = 'map-cluster-label';
+                label.style.left = `${cluster.x * size}px`;
+                label.style.top = `${cluster.y * size}px`;
+                label.textContent = cluster.label;
+                canvas.appendChild(label);
+            });
+
+            status.textContent = `${mapIndex.count} emotions to explore`;
+            map.scrollLeft = (size - map.clientWidth) / 2;
+            map.scrollTop = (size - map.clientHeight) / 2;
+            loadVisibleTiles();
+            map.addEventListener('scroll', loadVisibleTiles, { passive: true });
+        })
+        .catch(error => {
+            status.textContent = error.message;
+        });
+});
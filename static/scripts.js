@@ -0,0 +1,157 @@
+document.addEventListener('DOMContentLoaded', function() {
+    const descriptionText = document.getElementById('description-text');
+    const guidelinesText = document.getElementById('guidelines-text');
+    const pendingEmotions = document.getElementById('pending-emotions');
+
+    // Resolves once new emotions are shown, session updates have to wait for it to not get overwritten
+    let pendingRecommendations = Promise.resolve();
+
+    function bindEmotionButtons(root) {
+        // Creates logic for showing descriptions in left sidebar when hovering over words
+        root.querySelectorAll('.circle-button').forEach(button => {
+            button.addEventListener('mouseenter', function() {
+                descriptionText.innerHTML = this.getAttribute('data-description');
+                guidelinesText.style.display = 'none';
+                descriptionText.style.display = 'block';
+            });
+
+            button.addEventListener('mouseleave', function() {
+                guidelinesText.style.display = 'block';
+                descriptionText.style.display = 'none';
+            });
+        });
+
+        // Add initial in-collection class to buttons
+        root.querySelectorAll('.add-to-collection').forEach(btn => {
+            const emotion = btn.dataset.emotion;
+            if (document.querySelector(`.collection-item[data-emotion="${emotion}"]`)) {
+                btn.classList.add('in-collection');
+            }
+        });
+    }
+
+    bindEmotionButtons(document);
+
+    // Page was shown before new emotions were ready, fetch them now
+    if (pendingEmotions) {
+        // Block other choices until new emotions are in, as these would be invalidated (going back is fine)
+        const blockSubmit = function(e) {
+            if (e.target.getAttribute('action') !== '/') {
+                e.preventDefault();
+                e.stopImmediatePropagation();
+            }
+        };
+        document.addEventListener('submit', blockSubmit, true);
+
+        const showPendingMessage = function(message) {
+            pendingEmotions.classList.add('failed');
+            pendingEmotions.innerHTML = '';
+            const p = document.createElement('p');
+            p.className = 'text-center';
+            p.textContent = message;
+            pendingEmotions.appendChild(p);
+            return p;
+        };
+
+        // Resolves once the new emotions are shown, or when there is nothing to wait for anymore
+        const fetchRecommendations = function() {
+            return fetch(pendingEmotions.dataset.url, { method: 'POST' })
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error(`Finding new emotions failed with status ${response.status}`);
+                    }
+                    return response.json();
+                })
+                .then(data => {
+                    if (data.success) {
+                        const container = document.createElement('div');
+                        container.innerHTML = data.html;
+                        bindEmotionButtons(container);
+                        pendingEmotions.replaceWith(...container.childNodes);
+                    } else {
+                        // Nothing pending on the server, e.g. this page was opened again after the emotions were shown
+                        showPendingMessage('There are no new emotions waiting for this choice.');
+                    }
+                    document.removeEventListener('submit', blockSubmit, true);
+                })
+                .catch(() => {
+                    // Choice is still pending on the server, so retry the same request instead of choosing again
+                    const message = showPendingMessage('Could not find new emotions. ');
+                    return new Promise(resolve => {
+                        const retryButton = document.createElement('button');
+                        retryButton.type = 'button';
+                        retryButton.className = 'btn btn-secondary';
+                        retryButton.textContent = 'Try again';
+                        retryButton.addEventListener('click', () => {
+                            pendingEmotions.classList.remove('failed');
+                            pendingEmotions.innerHTML = '<p class="text-center">Finding new emotions...</p>';
+                            resolve(fetchRecommendations());
+                        });
+                        message.appendChild(retryButton);
+                    });
+                });
+        };
+
+        pendingRecommendations = fetchRecommendations();
+    }
+
+    // Logic for collection words and effects
+    function updateCollection(action, emotion) {
+        // Check if emotion is already in collection
+        const existingItem = document.querySelector(`.collection-item[data-emotion="${emotion}"]`);
+        if (action === 'add' && existingItem) {
+            return; // Don't add if already exists
+        }
+
+        pendingRecommendations
+        .then(() => fetch('/update_collection', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({ action, emotion })
+        }))
+        .then(response => response.json())
+        .then(data => {
+            if (data.success) {
+                const collectionList = document.getElementById('collection-list');
+                if (action === 'add') {
+                    const div = document.createElement('div');
+                    div.className = 'collection-item';
+                    div.dataset.emotion = emotion;
+                    div.innerHTML = `
+                        <span>${emotion}</span>
+                        <button class="remove-from-collection" data-emotion="${emotion}">×</button>
+                    `;
+                    collectionList.appendChild(div);
+
+                    // Update all add buttons for this emotion
+                    document.querySelectorAll(`.add-to-collection[data-emotion="${emotion}"]`)
+                        .forEach(btn => btn.classList.add('in-collection'));
+                } else {
+                    existingItem.remove();
+                    // Update all add buttons for this emotion
+                    document.querySelectorAll(`.add-to-collection[data-emotion="${emotion}"]`)
+                        .forEach(btn => btn.classList.remove('in-collection'));
+                }
+            }
+        });
+    }
+
+    // Add collection button handlers
+    document.body.addEventListener('click', function(e) {
+        if (e.target.classList.contains('add-to-collection')) {
+            updateCollection('add', e.target.dataset.emotion);
+        } else if (e.target.classList.contains('remove-from-collection')) {
+            updateCollection('remove', e.target.dataset.emotion);
+        }
+    });
+
+    // Add finish form handler
+    const finishForm = document.querySelector('form[action="/finish"]');
+    if (finishForm) {
+        finishForm.addEventListener('submit', function(e) {
+            e.preventDefault();
+            alert('You are finished! Take your receipt.');
+            this.submit();
+        });
+    }
+});
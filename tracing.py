@@ -0,0 +1,179 @@
+# E*star is an artwork on discovering intercultural language that describes emotion.
+# Copyright (C) 2024  Ferdinand Kok
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import uuid
+import base64
+import threading
+
+import numpy as np
+from flask import g, request, session, has_request_context
+
+import utils as utils
+
+####################
+#
+# tracing.py
+#
+# Opt-in recording of anonymised session traces, to replay real visitor behaviour with replay.py.
+# Every action of a visitor (route, form fields, timing) gets appended as a JSON line to a local log,
+# together with the embeddings returned by the embedder, so replays need no API calls.
+#
+# Anonymisation: visitors are only identified by a random trace id, and free text
+# (the experience description) is only stored as its length. Emotion names are kept,
+# along with their position on screen, so replays can make the same choices.
+#
+# Enable by setting ESTAR_TRACE_FILE to the path of the log to append to.
+#
+####################
+
+def encode_embedding(embedding):
+    """Encode an embedding compactly as base64 of its float32 bytes.
+
+    Args:
+        embedding (list[float]): embedding to encode
+
+    Returns:
+        str: base64 encoded embedding
+    """
+
+    return base64.b64encode(np.asarray(embedding, dtype='float32').tobytes()).decode('ascii')
+
+def decode_embedding(encoded):
+    """Decode an embedding encoded with encode_embedding.
+
+    Args:
+        encoded (str): base64 encoded embedding
+
+    Returns:
+        list[float]: decoded embedding
+    """
+
+    return np.frombuffer(base64.b64decode(encoded), dtype='float32').tolist()
+
+class _RecordingEmbeddings:
+    """Passes embedding requests on to the real client, keeping the results for the current trace."""
+
+    def __init__(self, embeddings):
+        self._embeddings = embeddings
+
+    def create(self, **kwargs):
+        response = self._embeddings.create(**kwargs)
+        if has_request_context() and 'trace_embeddings' in g:
+            g.trace_embeddings.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+        return response
+
+class RecordingClient:
+    """Wraps an OpenAI client so embeddings made during traced requests get recorded."""
+
+    def __init__(self, client):
+        self._client = client
+        self.embeddings = _RecordingEmbeddings(client.embeddings)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+def anonymise_fields(fields, previous_emotions):
+    """Anonymise form fields of an action, adding positions of chosen emotions for replays.
+
+    Args:
+        fields (dict): form or JSON fields of the request
+        previous_emotions (list): emotions shown to the visitor before this action
+
+    Returns:
+        dict: anonymised fields
+    """
+
+    anonymised = {}
+    for name, value in fields.items():
+        if name == 'user_input':
+            anonymised['user_input_length'] = len(value or '')
+        else:
+            anonymised[name] = value
+
+    # Position of the chosen emotion within the latest set of 3
+    chosen_emotion = fields.get('chosen_emotion')
+    if chosen_emotion in previous_emotions[-3:]:
+        anonymised['chosen_position'] = previous_emotions[-3:].index(chosen_emotion)
+
+    # Position of the target emotion within the set it was rewound to
+    target_emotion = fields.get('target_emotion')
+    if target_emotion is not None and str(fields.get('target_set_index', '')).isdigit():
+        set_index = int(fields['target_set_index'])
+        target_set = previous_emotions[set_index * 3:(set_index + 1) * 3]
+        if target_emotion in target_set:
+            anonymised['target_position'] = target_set.index(target_emotion)
+
+    return anonymised
+
+def init_tracing(app, client):
+    """Set up opt-in trace recording on the flask app, if ESTAR_TRACE_FILE is set.
+
+    Args:
+        app (flask.Flask): flask app to set up
+        client (OpenAI): OpenAI API client used by the app
+
+    Returns:
+        OpenAI: client to use in the app, wrapped to record embeddings if tracing is enabled
+    """
+
+    trace_file = os.environ.get('ESTAR_TRACE_FILE')
+    if not trace_file:
+        return client
+
+    write_lock = threading.Lock()
+    print(f"Recording session traces to {trace_file}")
+
+    @app.before_request
+    def start_trace():
+        if request.endpoint in utils.INTERNAL_ENDPOINTS or request.endpoint is None:
+            return
+
+        # Every new experience gets its own trace
+        if 'trace_id' not in session or request.endpoint == 'first_pass':
+            session['trace_id'] = uuid.uuid4().hex
+
+        g.trace_start = time.perf_counter()
+        g.trace_embeddings = []
+        # Snapshot before the action changes it, to find positions of chosen emotions
+        g.trace_previous_emotions = list(session.get('previous_emotions', []))
+
+    @app.after_request
+    def record_trace(response):
+        if 'trace_start' not in g:
+            return response
+
+        fields = request.get_json(silent=True) if request.is_json else request.form.to_dict()
+        event = {
+            'trace_id': session.get('trace_id'),
+            'time': round(time.time(), 3),
+            'endpoint': request.endpoint,
+            'method': request.method,
+            'path': request.path,
+            'fields': anonymise_fields(fields or {}, g.trace_previous_emotions),
+            'status': response.status_code,
+            'duration': round(time.perf_counter() - g.trace_start, 4),
+            'embeddings': [encode_embedding(embedding) for embedding in g.trace_embeddings]
+        }
+
+        with write_lock, open(trace_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(event, ensure_ascii=False) + '\n')
+
+        return response
+
+    return RecordingClient(client)
@@ -14,12 +14,35 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
+import sys
+import hmac
+import time
+
 import numpy as np
 import faiss
-from flask import render_template, jsonify
+from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+from flask import render_template, jsonify, abort
 
 from printing import print_emotion_collection
 
+# Endpoints that are not part of a visitor's session (files, research and admin routes),
+# skipped by both request profiling and trace recording
+INTERNAL_ENDPOINTS = {'static', 'assets', 'map_tile', 'batch_recommendations',
+                      'list_profiles', 'download_profile', 'view_flamegraph'}
+
+def check_admin_token(request):
+    """Abort with 403 unless the request carries the admin token (ESTAR_ADMIN_TOKEN) as ?token=.
+    Admin routes are unavailable altogether when no token is set.
+
+    Args:
+        request (flask.Request): current request
+    """
+    
+    admin_token = os.environ.get('ESTAR_ADMIN_TOKEN')
+    if not admin_token or not hmac.compare_digest(request.args.get('token', ''), admin_token):
+        abort(403)
+
 def get_embedding(description, client, model="text-embedding-3-large"):
     """uses the OpenAI API to create an embedding of the given text string
 
@@ -37,6 +60,78 @@ def get_embedding(description, client, model="text-embedding-3-large"):
     
     return client.embeddings.create(input = description, model = model).data[0].embedding
 
+def get_embeddings(descriptions, client, model="text-embedding-3-large", retries=10, delay=5):
+    """uses the OpenAI API to create embeddings of a batch of text strings in a single request
+
+    Args:
+        descriptions (list[str]): texts to be embedded
+        client (OpenAI): authenticated connection to OpenAI API
+        model (str, optional): OpenAI API model to use for the embedding. Defaults "text-embedding-3-large".
+        retries (int, optional): number of times to retry in case of a timeout, rate limit or server error. Defaults to 10.
+        delay (int, optional): delay between retries in seconds. Defaults to 5.
+
+    Raises:
+        openai.BadRequestError: if the request is rejected, e.g. a description is over the token limit (not retried)
+
+    Returns:
+        numpy.ndarray: float32 matrix of shape (len(descriptions), embedding_dim), in input order
+    """
+    
+    # newlines can cause problems with accurate embedding
+    descriptions = [str(description).replace("\n", " ") for description in descriptions]
+    
+    for attempt in range(retries):
+        try:
+            response = client.embeddings.create(input = descriptions, model = model)
+            break
+        # Only transient errors are worth waiting for, others (bad request, authentication) would fail again
+        except (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError) as e:
+            print(f"Error during embedding of {len(descriptions)} descriptions: {e}\nAmount of retries left: {retries - attempt}",
+                  file=sys.stderr)
+            if attempt < retries - 1:
+                time.sleep(delay)
+            else:
+                raise
+    
+    # API does not guarantee order of returned embeddings, so sort on index
+    data = sorted(response.data, key=lambda item: item.index)
+    
+    return np.array([item.embedding for item in data], dtype='float32')
+
+def modify_user_input(user_input):
+    """Wrap the user input in the prompt used for embedding, steering towards non-English emotions.
+
+    Args:
+        user_input (str): user input of current state
+
+    Returns:
+        str: prompt to be embedded
+    """
+    
+    return ('I am looking for NON ENGLISH emotions that best describe my experience. ' +
+            'This is a description of my experience: ' + 
+            user_input + 
+            ' Which emotion do you think best describes my experience?' + 
+            ' I want NON ENGLISH emotions! Only suggest English emotions if there are no other options available.')
+
+def get_percentile_bands(n_emotions):
+    """Get the index ranges of the distance-sorted search results to pick each of the 3 recommendations from.
+
+    Args:
+        n_emotions (int): amount of emotions in the search results
+
+    Returns:
+        list[tuple[int, int]]: (start, end) index range per recommendation, closest band first
+    """
+    
+    first_emotion_percentile = int(n_emotions * 0.05)
+    second_emotion_percentile = int(n_emotions * 0.1)
+    third_emotion_percentile = int(n_emotions * 0.3)
+    
+    return [(0, first_emotion_percentile),
+            (first_emotion_percentile, second_emotion_percentile),
+            (second_emotion_percentile, third_emotion_percentile)]
+
 def get_faiss_index(df_embeddings):
     """Create a Faiss index from the embeddings in the dataframe.
 
@@ -54,7 +149,7 @@ def get_faiss_index(df_embeddings):
     
     return faiss_index
 
-def find_relevant_emotions(user_input, emotion_list, client, faiss_index, previous_emotions=[]):
+def find_relevant_emotions(user_input, emotion_list, client, faiss_index, previous_emotions=[], reranker=None):
     """Find relevant emotions based on user input and previous selections.
     
     Args:
@@ -63,6 +158,7 @@ def find_relevant_emotions(user_input, emotion_list, client, faiss_index, previo
         client (OpenAI): OpenAI API client
         faiss_index (faiss.swigfaiss.IndexFlatL2): FAISS index of embeddings
         previous_emotions (list, optional): list of previously selected emotions. Defaults to [].
+        reranker (reranking.Reranker, optional): scores candidates within each band, closest first if None. Defaults to None.
 
     Returns:
         list: list of recommended emotions
@@ -70,20 +166,13 @@ def find_relevant_emotions(user_input, emotion_list, client, faiss_index, previo
     """
     
     # Generate embedding for the user input
-    user_input_modified = ('I am looking for NON ENGLISH emotions that best describe my experience. ' +
-                           'This is a description of my experience: ' + 
-                           user_input + 
-                           ' Which emotion do you think best describes my experience?' + 
-                           ' I want NON ENGLISH emotions! Only suggest English emotions if there are no other options available.')
+    user_input_modified = modify_user_input(user_input)
     user_embedding = get_embedding(user_input_modified, client)
     user_embedding = np.array(user_embedding, dtype='float32').reshape(1, -1)
     distances, indices = faiss_index.search(user_embedding, len(emotion_list))
     
     # Filter out selected emotions
     recommended_emotions = []
-    first_emotion_percentile = int(len(indices[0]) * 0.05)
-    second_emotion_percentile = int(len(indices[0]) * 0.1)
-    third_emotion_percentile = int(len(indices[0]) * 0.3)
     
     def get_emotion_from_percentile(start, end):
         #print out for debugging
@@ -107,9 +196,13 @@ def find_relevant_emotions(user_input, emotion_list, client, faiss_index, previo
         print(f"No valid emotion found")
         return None
     
-    recommended_emotions.append(get_emotion_from_percentile(0, first_emotion_percentile))
-    recommended_emotions.append(get_emotion_from_percentile(first_emotion_percentile, second_emotion_percentile))
-    recommended_emotions.append(get_emotion_from_percentile(second_emotion_percentile, third_emotion_percentile))
+    for start, end in get_percentile_bands(len(indices[0])):
+        if reranker is not None:
+            emotion = reranker.pick_from_band(distances[0], indices[0], start, end, previous_emotions, recommended_emotions)
+            if emotion is not None:
+                recommended_emotions.append(emotion)
+                continue
+        recommended_emotions.append(get_emotion_from_percentile(start, end))
     
     if not recommended_emotions:
         # Handle end of list
@@ -161,10 +254,54 @@ def get_descriptions(df_embeddings, emotions):
             for emotion in emotions}
 
 
+def render_pending_results(df_embeddings, user_input, previous_sets, session):
+    """Render the results page without new emotions, to show it before the embedding and search are done.
+    New emotions get fetched by the page afterwards, through handle_recommendations().
+
+    Args:
+        df_embeddings (pandas.core.frame.DataFrame): DataFrame of embeddings and metadata
+        user_input (str): user input of current state, to find new emotions for
+        previous_sets (list[list[str]]): sets of emotions shown so far
+        session (flask.sessions.SecureCookieSession): session object storing user state
+
+    Returns:
+        render_template: render the results.html template with a pending indicator for new emotions
+    """
+    
+    session['pending_user_input'] = user_input
+    session.modified = True
+    
+    descriptions = get_descriptions(df_embeddings, session['previous_emotions'])
+    return render_template('results.html',
+                           emotions=[],
+                           pending=True,
+                           user_input=user_input,
+                           previous_sets=previous_sets,
+                           chosen_emotions=session['chosen_emotions'],
+                           original_user_input=session['original_user_input'],
+                           descriptions=descriptions)
+
+
 ##########################
 ##### Route handlers #####
 ##########################
 
+def init_session(session, user_input=''):
+    """Start a new visitor's session, so nothing of a previous visitor on the same browser carries over.
+
+    Args:
+        session (flask.sessions.SecureCookieSession): session object storing user state
+        user_input (str, optional): user input of current state, empty when starting without an experience. Defaults to ''.
+    """
+    
+    # Initialise session variables, for easy passing between routes/functions
+    session['previous_emotions'] = []
+    session['chosen_emotions'] = []
+    session['original_user_input'] = user_input
+    session['user_input'] = user_input
+    session['collection'] = []
+    session.pop('pending_user_input', None)
+
 def handle_first_pass(user_input, session, df_embeddings):
     """Handle the first pass of the emotion selection process.
 
@@ -181,12 +318,7 @@ def handle_first_pass(user_input, session, df_embeddings):
         # Ensure user inputted sentence ends with a period
         user_input += '.'
     
-    # Initialise session variables, for easy passing between routes/functions
-    session['previous_emotions'] = []
-    session['chosen_emotions'] = []
-    session['original_user_input'] = user_input
-    session['user_input'] = user_input
-    session['collection'] = []
+    init_session(session, user_input)
 
     # Get recommended_emotions for the first pass
     recommended_emotions = find_relevant_base_emotions()
@@ -205,7 +337,7 @@ def handle_first_pass(user_input, session, df_embeddings):
                            original_user_input=user_input,
                            descriptions=descriptions)
 
-def handle_get_emotions(user_input, chosen_emotion, df_embeddings, session, client, faiss_index, emotion_list):
+def handle_get_emotions(user_input, chosen_emotion, df_embeddings, session, client, faiss_index, emotion_list, reranker=None, stream=False):
     """Handle the selection of a new emotion.
 
     Args:
@@ -215,6 +347,8 @@ def handle_get_emotions(user_input, chosen_emotion, df_embeddings, session, clie
         session (flask.sessions.SecureCookieSession): session object storing user state
         client (OpenAI): OpenAI API client
         faiss_index (faiss.swigfaiss.IndexFlatL2): FAISS index of embeddings
+        reranker (reranking.Reranker, optional): scores candidates within each band. Defaults to None.
+        stream (bool, optional): render the page right away, with new emotions fetched afterwards. Defaults to False.
 
     Returns:
         render_template: render the results.html template with the updated results
@@ -242,13 +376,17 @@ def handle_get_emotions(user_input, chosen_emotion, df_embeddings, session, clie
     # Append chosen emotion and other emotions to user input
     user_input += f" I feel that '{chosen_emotion}' describes my experience better than '{other_emotions[0]}' and '{other_emotions[1]}'."
     
+    if stream:
+        return render_pending_results(df_embeddings, user_input, previous_sets, session)
+    
     # Get recommended_emotions
     recommended_emotions = find_relevant_emotions(
         user_input=user_input, 
         emotion_list=emotion_list, 
         previous_emotions=previous_emotions, 
         client=client, 
-        faiss_index=faiss_index
+        faiss_index=faiss_index,
+        reranker=reranker
     )
     
     # Append recommended_emotions to previous_emotions
@@ -268,7 +406,7 @@ def handle_get_emotions(user_input, chosen_emotion, df_embeddings, session, clie
                            original_user_input=original_user_input,
                            descriptions=descriptions)
     
-def handle_rewind_to_emotion(target_emotion, target_set_index, df_embeddings, session, client, faiss_index, emotion_list):
+def handle_rewind_to_emotion(target_emotion, target_set_index, df_embeddings, session, client, faiss_index, emotion_list, reranker=None, stream=False):
     """Handle the rewinding to a previous emotion, and corresponding system state.
 
     Args:
@@ -278,6 +416,8 @@ def handle_rewind_to_emotion(target_emotion, target_set_index, df_embeddings, se
         session (flask.sessions.SecureCookieSession): session object storing user state
         client (OpenAI): OpenAI API client
         faiss_index (faiss.swigfaiss.IndexFlatL2): FAISS index of embeddings
+        reranker (reranking.Reranker, optional): scores candidates within each band. Defaults to None.
+        stream (bool, optional): render the page right away, with new emotions fetched afterwards. Defaults to False.
 
     Returns:
         render_template: render the results.html template with the updated results
@@ -319,13 +459,17 @@ def handle_rewind_to_emotion(target_emotion, target_set_index, df_embeddings, se
     # Create sets of previous emotions
     previous_sets = [previous_emotions[i:i+3] for i in range(0, len(previous_emotions), 3)]
     
+    if stream:
+        return render_pending_results(df_embeddings, user_input, previous_sets, session)
+    
     # Get new recommendations based on rewound state
     recommended_emotions = find_relevant_emotions(
         user_input=user_input,
         emotion_list=emotion_list,
         previous_emotions=previous_emotions,
         client=client,
-        faiss_index=faiss_index
+        faiss_index=faiss_index,
+        reranker=reranker
     )
     
     # Append recommended_emotions to previous_emotions
@@ -341,7 +485,7 @@ def handle_rewind_to_emotion(target_emotion, target_set_index, df_embeddings, se
                             original_user_input=original_user_input,
                             descriptions=descriptions)
     
-def handle_skip_emotions(df_embeddings, user_input, session, client, faiss_index, emotion_list):
+def handle_skip_emotions(df_embeddings, user_input, session, client, faiss_index, emotion_list, reranker=None, stream=False):
     """Handle the skipping of emotions.
 
     Args:
@@ -350,6 +494,8 @@ def handle_skip_emotions(df_embeddings, user_input, session, client, faiss_index
         session (flask.sessions.SecureCookieSession): session object storing user state
         client (OpenAI): OpenAI API client
         faiss_index (faiss.swigfaiss.IndexFlatL2): FAISS index of embeddings
+        reranker (reranking.Reranker, optional): scores candidates within each band. Defaults to None.
+        stream (bool, optional): render the page right away, with new emotions fetched afterwards. Defaults to False.
 
     Returns:
         render_template: render the results.html template with the updated results
@@ -371,13 +517,18 @@ def handle_skip_emotions(df_embeddings, user_input, session, client, faiss_index
     # Necessary for making session updates stick
     session.modified = True
     
+    if stream:
+        previous_sets = [previous_emotions[i:i+3] for i in range(0, len(previous_emotions), 3)]
+        return render_pending_results(df_embeddings, user_input, previous_sets, session)
+    
     # Generate new recommended emotions
     recommended_emotions = find_relevant_emotions(
         user_input=user_input,
         emotion_list=emotion_list,
         previous_emotions=previous_emotions,
         client=client,
-        faiss_index=faiss_index
+        faiss_index=faiss_index,
+        reranker=reranker
     )
     
     # Append recommended emotions to previous_emotions
@@ -397,6 +548,52 @@ def handle_skip_emotions(df_embeddings, user_input, session, client, faiss_index
                            original_user_input=original_user_input,
                            descriptions=descriptions)
     
+def handle_recommendations(df_embeddings, session, client, faiss_index, emotion_list, reranker=None):
+    """Handle fetching the new emotions for a results page that was rendered while they were pending.
+
+    Args:
+        df_embeddings (pandas.core.frame.DataFrame): DataFrame of embeddings and metadata
+        session (flask.sessions.SecureCookieSession): session object storing user state
+        client (OpenAI): OpenAI API client
+        faiss_index (faiss.swigfaiss.IndexFlatL2): FAISS index of embeddings
+        emotion_list (list): list of emotions to choose from
+        reranker (reranking.Reranker, optional): scores candidates within each band. Defaults to None.
+
+    Returns:
+        jsonify: JSON response with the rendered set of new emotions
+    """
+    
+    # Nothing pending, e.g. when the page got refreshed after the emotions were already fetched
+    user_input = session.get('pending_user_input')
+    if user_input is None:
+        return jsonify({'success': False})
+    
+    previous_emotions = session['previous_emotions']
+    
+    recommended_emotions = find_relevant_emotions(
+        user_input=user_input,
+        emotion_list=emotion_list,
+        previous_emotions=previous_emotions,
+        client=client,
+        faiss_index=faiss_index,
+        reranker=reranker
+    )
+    
+    # Only cleared once found, so a failed request (e.g. embedder error) can be retried for the same choice
+    session.pop('pending_user_input', None)
+    
+    # Append recommended emotions to previous_emotions
+    previous_emotions.extend(recommended_emotions)
+    session.modified = True
+    
+    descriptions = get_descriptions(df_embeddings, recommended_emotions)
+    html = render_template('emotion_set.html',
+                           emotions=recommended_emotions,
+                           user_input=user_input,
+                           descriptions=descriptions)
+    
+    return jsonify({'success': True, 'html': html})
+
 def handle_finish(df_embeddings, user_input, session):
     """Handle the printing of the receipt with emotions from collection.
 